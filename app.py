@@ -1,12 +1,24 @@
 import gradio as gr
 import google.generativeai as genai
+from aiolimiter import AsyncLimiter
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+from google.api_core import exceptions as google_exceptions
+from googleapiclient.errors import HttpError
 import os
 import asyncio
-import pandas as pd
+import httpx
+import json
 import io
-import mimetypes
-import html
+import base64
 import tempfile # <-- 最终修复点 1: 导入 tempfile 库
+import functools
+import hashlib
+import mimetypes
+import queue
+import threading
+from collections import OrderedDict
+from types import MappingProxyType
+from time import strftime, localtime, monotonic
 
 # --- Google API Key 配置 ---
 API_KEY = os.getenv("GOOGLE_API_KEY")
@@ -19,75 +31,631 @@ except Exception as e:
     raise RuntimeError(f"配置 Google GenAI 失败：{e}")
 
 # --- 统一的模型映射字典 ---
-MODEL_MAPPING = {
+MODEL_MAPPING = MappingProxyType({
     "Gemini 2.5 Flash (快速高效)": "gemini-2.5-flash",
     "Gemini 2.5 Pro (深度理解)": "gemini-2.5-pro",
+})
+MODEL_CHOICES = tuple(MODEL_MAPPING)
+DEFAULT_MODEL_ID = MODEL_MAPPING[MODEL_CHOICES[0]]
+
+
+# --- 默认并发上限，可通过环境变量按账号配额调整（限制在滑块范围 1-10 内） ---
+DEFAULT_MAX_CONCURRENCY = min(max(int(os.getenv("GEMINI_MAX_CONCURRENCY", "5")), 1), 10)
+# --- 默认每分钟请求上限（RPM），免费层 Flash 约 15，付费层约 60 ---
+DEFAULT_RPM = max(int(os.getenv("GEMINI_RPM", "60")), 1)
+# --- 可同时运行的分析事件数：Gradio 默认每个事件只允许 1 个，而 Batch 模式的一次点击可能持续数小时 ---
+DEFAULT_EVENT_CONCURRENCY = max(int(os.getenv("GEMINI_EVENT_CONCURRENCY", "4")), 1)
+
+
+# --- 常见音频扩展名到 MIME 类型的映射（上传控件仅接受音频文件），表外扩展名回退到 mimetypes ---
+_EXT_TO_MIME = {
+    '.mp3': 'audio/mpeg',
+    '.wav': 'audio/wav',
+    '.flac': 'audio/flac',
+    '.ogg': 'audio/ogg',
+    '.oga': 'audio/ogg',
+    '.opus': 'audio/ogg',
+    '.m4a': 'audio/mp4',
+    '.aac': 'audio/aac',
+    '.aiff': 'audio/aiff',
+    '.aif': 'audio/aiff',
 }
 
 
+def _guess_mime(filename: str) -> str:
+    mime_type = _EXT_TO_MIME.get(os.path.splitext(filename)[1].lower())
+    if mime_type is None:
+        mime_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    return mime_type
+
+
+# --- 小于该阈值的音频预览直接内嵌为 data: URL，省去经 Gradio /file= 代理的二次读取 ---
+_INLINE_PREVIEW_MAX_BYTES = 2 << 20
+# --- 每批预览内嵌的总字节上限，用完后其余文件回退到 /file= 链接，避免单次 Markdown 更新过大 ---
+_INLINE_PREVIEW_TOTAL_BYTES = 6 << 20
+
+
+# --- 内联请求体上限 20 MB 针对整个请求（音频 + 指令文本 + 协议开销），音频超出剩余额度时改用 Files API 上传后按引用传递 ---
+_INLINE_REQUEST_MAX_BYTES = 20_000_000
+_INLINE_REQUEST_HEADROOM_BYTES = 64 << 10
+
+
+# --- 模型实例缓存：同一 model_id 在所有任务间共享 ---
+@functools.lru_cache(maxsize=8)
+def _get_model(model_id: str) -> genai.GenerativeModel:
+    return genai.GenerativeModel(model_id)
+
+
+# --- 账号级 RPM 限流器：所有用户和批次共用同一个 GOOGLE_API_KEY，因此整个进程只用一个按 GEMINI_RPM 设定的令牌桶 ---
+@functools.lru_cache(maxsize=1)
+def _get_rate_limiter() -> AsyncLimiter:
+    return AsyncLimiter(max_rate=DEFAULT_RPM, time_period=60)
+
+
+# --- 429/503 重试：优先采用服务端建议的等待时间，否则指数退避加抖动 ---
+_RETRYABLE_ERRORS = (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable)
+_BACKOFF_WAIT = wait_exponential_jitter(initial=2, max=30)
+
+
+def _server_retry_delay(exc: BaseException) -> float | None:
+    # REST 传输通过 Retry-After 响应头给出，gRPC 传输通过 RetryInfo 错误详情给出
+    headers = getattr(getattr(exc, 'response', None), 'headers', None) or {}
+    retry_after = headers.get('retry-after')
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    for detail in getattr(exc, 'details', None) or []:
+        delay = getattr(detail, 'retry_delay', None)
+        if delay is not None:
+            return delay.seconds + delay.nanos / 1e9
+    return None
+
+
+def _retry_wait(retry_state) -> float:
+    delay = _server_retry_delay(retry_state.outcome.exception())
+    return min(delay, 60) if delay is not None else _BACKOFF_WAIT(retry_state)
+
+
+# --- 结果缓存：音频内容、指令、模型与压缩选项完全相同时直接复用上次的成功结果 ---
+_RESULT_CACHE_MAX_ENTRIES = 128
+_result_cache = OrderedDict()
+
+
+def _cache_get(key: tuple) -> str | None:
+    text = _result_cache.get(key)
+    if text is not None:
+        _result_cache.move_to_end(key)
+    return text
+
+
+def _cache_put(key: tuple, text: str) -> None:
+    _result_cache[key] = text
+    _result_cache.move_to_end(key)
+    while len(_result_cache) > _RESULT_CACHE_MAX_ENTRIES:
+        _result_cache.popitem(last=False)
+
+
+# --- 通道预热：首个页面加载时发起一次 count_tokens 请求（不计费），提前完成 TLS/HTTP2 握手 ---
+_channel_warmed_up = False
+
+
+async def _warm_up_channel():
+    global _channel_warmed_up
+    if _channel_warmed_up:
+        return
+    _channel_warmed_up = True
+    try:
+        await _get_model(DEFAULT_MODEL_ID).count_tokens_async("ping")
+    except Exception:
+        pass  # 预热失败不影响正常分析流程
+
+
+# --- 文件读取辅助函数 ---
+def _read_file(path: str) -> bytes:
+    # 无缓冲 FileIO.readall 依据 fstat 的文件大小一次性分配 bytes，无需再从 bytearray 复制一份
+    with open(path, 'rb', buffering=0) as f:
+        return f.readall()
+
+
+def _hash_file(path: str) -> bytes:
+    # 分块读取计算内容摘要，无需将整个文件载入内存
+    h = hashlib.blake2b(digest_size=16)
+    buf = bytearray(1 << 20)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        while n := f.readinto(buf):
+            h.update(view[:n])
+    return h.digest()
+
+
+# --- 可选的 Opus 压缩：通过 ffmpeg 转码为 24 kbps、16 kHz 单声道 Ogg/Opus，减小上传体积 ---
+# Gemini 处理音频时本身会降采样到 16 kHz，因此降采样不会损失可用信息
+async def _transcode_to_opus(path: str) -> bytes | None:
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            'ffmpeg', '-loglevel', 'error', '-i', path, '-c:a', 'libopus', '-b:a', '24k', '-ac', '1', '-ar', '16000', '-f', 'ogg', 'pipe:1',
+            stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        )
+    except FileNotFoundError:
+        return None  # 未安装 ffmpeg，回退为原始音频
+    try:
+        stdout, _ = await proc.communicate()
+    except asyncio.CancelledError:
+        # 任务被取消（致命错误或页面关闭）时结束 ffmpeg 进程，避免遗留后台转码
+        proc.kill()
+        await proc.wait()
+        raise
+    return stdout if proc.returncode == 0 and stdout else None
+
+
+# --- Files API 上传：等待文件处理完成后返回可直接放入 contents 的文件引用 ---
+# upload_file 走 googleapiclient，抛出的是 HttpError；鉴权与配额错误换成对应的 google.api_core 异常，以便触发致命错误处理
+_UPLOAD_FATAL_HTTP_ERRORS = {
+    401: google_exceptions.Unauthenticated,
+    403: google_exceptions.PermissionDenied,
+    429: google_exceptions.ResourceExhausted,
+}
+# 文件处理（PROCESSING）的最长等待时间；等待期间仍占用工作信号量
+_UPLOAD_PROCESSING_MAX_WAIT_SECONDS = 300
+
+
+async def _upload_audio(source, mime_type: str):
+    try:
+        file_ref = await asyncio.to_thread(genai.upload_file, source, mime_type=mime_type)
+    except HttpError as e:
+        exc_type = _UPLOAD_FATAL_HTTP_ERRORS.get(e.resp.status)
+        if exc_type is None:
+            raise
+        raise exc_type(str(e)) from e
+    try:
+        async with asyncio.timeout(_UPLOAD_PROCESSING_MAX_WAIT_SECONDS):
+            while file_ref.state.name == "PROCESSING":
+                await asyncio.sleep(1)
+                file_ref = await asyncio.to_thread(genai.get_file, file_ref.name)
+    except TimeoutError as e:
+        raise TimeoutError(f"文件处理超过 {_UPLOAD_PROCESSING_MAX_WAIT_SECONDS} 秒仍未完成: {file_ref.name}") from e
+    if file_ref.state.name != "ACTIVE":
+        raise RuntimeError(f"文件处理失败，状态: {file_ref.state.name}")
+    return file_ref
+
+
+# --- Files API 上传缓存：按 (内容摘要, 是否压缩) 复用已上传的文件，服务端默认保留 48 小时 ---
+_UPLOAD_TTL_SECONDS = 47 * 3600
+_UPLOAD_CACHE_MAX_ENTRIES = 512
+_upload_cache = OrderedDict()
+
+
+def _cached_upload(cache_key: tuple, min_remaining: float = 0):
+    # min_remaining：要求文件在服务端至少还能保留这么久，否则视为未命中（条目本身保留）
+    entry = _upload_cache.get(cache_key)
+    if entry is None:
+        return None
+    if entry[1] <= monotonic():
+        del _upload_cache[cache_key]
+        return None
+    if entry[1] - monotonic() < min_remaining:
+        return None
+    return entry[0]
+
+
+def _remember_upload(cache_key: tuple, file_ref) -> None:
+    _upload_cache[cache_key] = (file_ref, monotonic() + _UPLOAD_TTL_SECONDS)
+    _upload_cache.move_to_end(cache_key)
+    # 有效期相同，插入顺序即过期顺序：先清理队首已过期的条目，再按容量淘汰最早的上传
+    now = monotonic()
+    while _upload_cache and (len(_upload_cache) > _UPLOAD_CACHE_MAX_ENTRIES or next(iter(_upload_cache.values()))[1] <= now):
+        _upload_cache.popitem(last=False)
+
+
+def _forget_upload(cache_key: tuple) -> None:
+    _upload_cache.pop(cache_key, None)
+
+
+# --- HTML 转义表：与 html.escape(quote=True) 等价，单次遍历完成替换 ---
+_HTML_TRANS = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#x27;'})
+
+
+# --- 后台 Excel 写入线程：随任务完成逐行写入，与 Gemini 推理重叠进行 ---
+_EXCEL_HEADERS = ["文件名", "状态", "消息", "分析结果", "错误详情"]
+
+
+def _excel_writer_worker(rows: queue.Queue, path: str) -> None:
+    import xlsxwriter  # 仅在首次导出时加载，不拖慢应用启动
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'strings_to_urls': False})
+    try:
+        worksheet = workbook.add_worksheet('AnalysisResults')
+        worksheet.write_row(0, 0, _EXCEL_HEADERS)
+        # constant_memory 模式要求按行顺序写入，先到的后序结果暂存直到前序行就绪
+        pending, next_idx = {}, 0
+        while (item := rows.get()) is not None:
+            idx, res = item
+            pending[idx] = res
+            while next_idx in pending:
+                res = pending.pop(next_idx)
+                worksheet.write_row(next_idx + 1, 0, [res.get('filename'), res.get('status'), res.get('message'), res.get('result'), res.get('error_details')])
+                next_idx += 1
+    finally:
+        workbook.close()
+
+
+# --- 致命错误：API Key 失效或配额耗尽时，继续提交其余任务只会浪费请求 ---
+class FatalGeminiError(Exception):
+    def __init__(self, result: dict):
+        super().__init__(result['error_details'])
+        self.result = result
+
+
 # --- 后台异步任务处理函数 ---
-async def async_gemini_analysis_task(prompt: str, file_data: dict, model_id: str, semaphore: asyncio.Semaphore):
-    filename, audio_bytes, mime_type = file_data['filename'], file_data['bytes'], file_data['type']
+async def _prepare_audio_part(file_data: dict, compress: bool, inline_limit: int) -> tuple:
+    # 返回 (音频 Part 或 Files API 文件引用, 是否来自上传缓存)
+    cache_key = (file_data['hash'], compress)
+    file_ref = _cached_upload(cache_key)
+    if file_ref is not None:
+        return file_ref, True
+    mime_type = file_data['type']
+    audio_bytes = await _transcode_to_opus(file_data['path']) if compress else None
+    if audio_bytes is not None:
+        mime_type = 'audio/ogg'
+    audio_size = len(audio_bytes) if audio_bytes is not None else os.path.getsize(file_data['path'])
+    if audio_size > inline_limit:
+        file_ref = await _upload_audio(io.BytesIO(audio_bytes) if audio_bytes is not None else file_data['path'], mime_type)
+        _remember_upload(cache_key, file_ref)
+        return file_ref, False
+    if audio_bytes is None:
+        audio_bytes = await asyncio.to_thread(_read_file, file_data['path'])
+    return genai.protos.Part(inline_data=genai.protos.Blob(mime_type=mime_type, data=audio_bytes)), False
+
+
+async def _generate_text(model: genai.GenerativeModel, contents: list, limiter: AsyncLimiter, on_partial=None) -> str:
+    # 限流器只包住实际的生成请求，令牌在真正发出请求时才被消耗；先按本次任务的 RPM 排队，再占用账号级额度
+    # 重试耗尽后原异常照常抛出，ResourceExhausted 仍会触发 FatalGeminiError
+    async for attempt in AsyncRetrying(retry=retry_if_exception_type(_RETRYABLE_ERRORS), wait=_retry_wait, stop=stop_after_attempt(5), reraise=True):
+        with attempt:
+            async with limiter, _get_rate_limiter():
+                response = await model.generate_content_async(contents, stream=True)
+            # 流式接收：流未读完前 response.text 会抛出 IncompleteIterationError，因此自行累积各分块的文本
+            acc = []
+            async for chunk in response:
+                try:
+                    acc.append(chunk.text)
+                except ValueError:
+                    continue  # 该分块不含文本（例如仅携带结束原因）
+                if on_partial is not None:
+                    on_partial("".join(acc))
+    return "".join(acc)
+
+
+async def async_gemini_analysis_task(prompt_part: genai.protos.Part, file_data: dict, model_id: str, semaphore: asyncio.Semaphore, limiter: AsyncLimiter, compress: bool = False, on_partial=None):
+    filename = file_data['filename']
     try:
         async with semaphore:
-            model = genai.GenerativeModel(model_id)
-            response = await model.generate_content_async([prompt, {'mime_type': mime_type, 'data': audio_bytes}])
-            return {'filename': filename, 'status': '✅ 完成', 'message': "分析成功", 'result': response.text, 'error_details': None}
+            # 获得信号量后才读取文件，内存峰值约为 max_concurrent_workers 个文件的大小
+            model = _get_model(model_id)
+            inline_limit = _INLINE_REQUEST_MAX_BYTES - _INLINE_REQUEST_HEADROOM_BYTES - len(prompt_part.text.encode())
+            audio_part, from_cache = await _prepare_audio_part(file_data, compress, inline_limit)
+            try:
+                text = await _generate_text(model, [prompt_part, audio_part], limiter, on_partial)
+            except (google_exceptions.NotFound, google_exceptions.PermissionDenied):
+                if not from_cache:
+                    raise
+                # 缓存的文件可能已在服务端过期或被删除：作废该缓存项并重新上传一次
+                _forget_upload((file_data['hash'], compress))
+                audio_part, _ = await _prepare_audio_part(file_data, compress, inline_limit)
+                text = await _generate_text(model, [prompt_part, audio_part], limiter, on_partial)
+            return {'filename': filename, 'status': '✅ 完成', 'message': "分析成功", 'result': text, 'error_details': None}
+    except (google_exceptions.PermissionDenied, google_exceptions.Unauthenticated, google_exceptions.ResourceExhausted) as e:
+        raise FatalGeminiError({'filename': filename, 'status': '⛔ 中止', 'message': f"致命错误，已取消剩余任务: {type(e).__name__}", 'result': None, 'error_details': str(e)}) from e
     except genai.types.BlockedPromptException as e:
         return {'filename': filename, 'status': '⚠️ 被阻止', 'message': "请求因安全设置被阻止", 'result': None, 'error_details': str(e)}
     except Exception as e:
         return {'filename': filename, 'status': '❌ 失败', 'message': f"分析过程中发生错误: {type(e).__name__}", 'result': None, 'error_details': str(e)}
 
 
+# --- 任务完成后把 (序号, None, 结果) 放入事件队列；致命错误以 (序号, None, 异常) 上报，流式分块以 (序号, 部分文本, None) 的形式进入同一队列 ---
+async def _run_and_report(idx: int, coro, events: asyncio.Queue):
+    try:
+        res = await coro
+    except FatalGeminiError as e:
+        res = e
+    events.put_nowait((idx, None, res))
+
+
+# --- Gemini Batch API：整批请求一次提交、由服务端排队执行，费用约为在线调用的一半 ---
+_BATCH_API_BASE = "https://generativelanguage.googleapis.com/v1beta"
+_BATCH_POLL_INTERVAL = 10
+# --- Batch API 的处理时限为 24 小时，超过后不再等待并请求服务端取消任务 ---
+_BATCH_MAX_WAIT_SECONDS = 24 * 3600
+
+
+def _batch_item_to_result(filename: str, item: dict) -> dict:
+    if 'error' in item:
+        return {'filename': filename, 'status': '❌ 失败', 'message': "批处理请求失败", 'result': None, 'error_details': json.dumps(item['error'], ensure_ascii=False)}
+    response = item.get('response', {})
+    parts = [part.get('text', '') for candidate in response.get('candidates', [])[:1] for part in candidate.get('content', {}).get('parts', [])]
+    if not any(parts):
+        block_reason = response.get('promptFeedback', {}).get('blockReason')
+        if block_reason:
+            return {'filename': filename, 'status': '⚠️ 被阻止', 'message': "请求因安全设置被阻止", 'result': None, 'error_details': block_reason}
+        return {'filename': filename, 'status': '❌ 失败', 'message': "批处理响应中没有文本结果", 'result': None, 'error_details': json.dumps(response, ensure_ascii=False)}
+    return {'filename': filename, 'status': '✅ 完成', 'message': "分析成功（Batch API）", 'result': "".join(parts), 'error_details': None}
+
+
+async def _run_batch_job(prompt: str, files_data: list, model_id: str, semaphore: asyncio.Semaphore, compress: bool = False, on_poll=None) -> list:
+    # 所有音频经 Files API 上传（命中上传缓存则直接复用），批处理请求体只包含文件 URI
+    # 批处理最长可排队 _BATCH_MAX_WAIT_SECONDS，只复用在此期间不会在服务端过期的上传
+    async def _file_ref(data: dict):
+        cache_key = (data['hash'], compress)
+        file_ref = _cached_upload(cache_key, min_remaining=_BATCH_MAX_WAIT_SECONDS)
+        if file_ref is None:
+            # 上传并发数与逐个请求模式共用同一信号量
+            async with semaphore:
+                source, mime_type = data['path'], data['type']
+                audio_bytes = await _transcode_to_opus(source) if compress else None
+                if audio_bytes is not None:
+                    source, mime_type = io.BytesIO(audio_bytes), 'audio/ogg'
+                file_ref = await _upload_audio(source, mime_type)
+            _remember_upload(cache_key, file_ref)
+        return file_ref
+
+    file_refs = await asyncio.gather(*[_file_ref(data) for data in files_data])
+    batch_requests = [
+        {
+            'request': {'contents': [{'parts': [{'text': prompt}, {'file_data': {'mime_type': file_ref.mime_type, 'file_uri': file_ref.uri}}]}]},
+            'metadata': {'key': str(key)},
+        }
+        for key, file_ref in enumerate(file_refs)
+    ]
+
+    async with httpx.AsyncClient(base_url=_BATCH_API_BASE, headers={'x-goog-api-key': API_KEY}, timeout=60) as client:
+        resp = await client.post(f"/models/{model_id}:batchGenerateContent", json={'batch': {'display_name': 'gemini-audio-batch', 'input_config': {'requests': {'requests': batch_requests}}}})
+        if resp.is_error:
+            raise google_exceptions.from_http_response(resp)
+        operation = resp.json()
+        try:
+            async with asyncio.timeout(_BATCH_MAX_WAIT_SECONDS):
+                while not operation.get('done'):
+                    await asyncio.sleep(_BATCH_POLL_INTERVAL)
+                    resp = await client.get(f"/{operation['name']}")
+                    if resp.is_error:
+                        raise google_exceptions.from_http_response(resp)
+                    operation = resp.json()
+                    if on_poll is not None:
+                        on_poll(operation.get('metadata', {}).get('state'))
+        except (asyncio.CancelledError, TimeoutError) as e:
+            # 不再等待结果时通知服务端取消，避免任务继续排队占用配额；取消请求失败不掩盖原始异常
+            try:
+                await client.post(f"/{operation['name']}:cancel")
+            except httpx.HTTPError:
+                pass
+            if isinstance(e, TimeoutError):
+                raise TimeoutError(f"批处理任务超过 {_BATCH_MAX_WAIT_SECONDS // 3600} 小时仍未完成，已请求取消") from e
+            raise
+
+    state = operation.get('metadata', {}).get('state')
+    results = [{'filename': data['filename'], 'status': '❌ 失败', 'message': f"批处理任务未成功完成: {state}", 'result': None, 'error_details': json.dumps(operation.get('error'), ensure_ascii=False) if 'error' in operation else None} for data in files_data]
+    # 内联响应与请求顺序一致；若带有 metadata.key 则以其为准
+    for position, item in enumerate(operation.get('response', {}).get('inlinedResponses', {}).get('inlinedResponses', [])):
+        idx = int(item.get('metadata', {}).get('key', position))
+        results[idx] = _batch_item_to_result(files_data[idx]['filename'], item)
+    for data, res in zip(files_data, results):
+        if res['result'] is None:
+            _forget_upload((data['hash'], compress))  # 失败的请求可能引用了已失效的文件，下次重新上传
+    return results
+
+
+# --- HTML 模板：模块加载时构建一次，渲染时直接 format ---
+_RESULT_TMPL = """<div style="border: 1px solid #e0e0e0; padding: 15px; border-radius: 8px; margin-bottom: 15px;"><h4>文件 {idx}: {name} - 状态: <span style="font-weight:bold;">{status}</span></h4><p><strong>消息:</strong> {msg}</p>{body}</div>"""
+_RESULT_BODY_TMPL = "<h5>分析结果:</h5><div style='background-color:#f9f9f9; padding: 10px; border-radius: 5px; white-space: pre-wrap; word-wrap: break-word;'>{result}</div>"
+_ERROR_TMPL = """<div><h4>文件 {idx}: {name} - 错误: {msg}</h4><pre><code>{details}</code></pre></div>"""
+_PREVIEW_TMPL = """<div style="margin-bottom: 10px;"><h4>文件 {idx}: {name}</h4><audio controls src="{src}" style="width: 100%;"></audio><p>大小: {size}</p></div>"""
+
+
+# --- 流式结果的界面刷新间隔（秒），避免每个分块都重绘全部结果 ---
+_PARTIAL_REFRESH_INTERVAL = 0.5
+
+
+def _inline_preview_flags(sizes: list) -> list:
+    # 按上传顺序分配内嵌额度
+    budget, flags = _INLINE_PREVIEW_TOTAL_BYTES, []
+    for size in sizes:
+        inline = size < _INLINE_PREVIEW_MAX_BYTES and size <= budget
+        if inline:
+            budget -= size
+        flags.append(inline)
+    return flags
+
+
+async def _preview_src(path: str, mime_type: str, inline: bool) -> str:
+    if inline:
+        preview_bytes = await asyncio.to_thread(_read_file, path)
+        return f"data:{mime_type};base64,{base64.b64encode(preview_bytes).decode()}"
+    return f"file={path}"
+
+
+def _fmt_size(size_bytes: int) -> str:
+    return f"{size_bytes / (1 << 20):.2f} MB"
+
+
+# --- 单个结果的 HTML 渲染，返回 (结果片段, 错误片段) ---
+def _render_result(idx: int, res: dict) -> tuple:
+    body = _RESULT_BODY_TMPL.format(result=res['result'].translate(_HTML_TRANS)) if res['result'] else ""
+    output_html = _RESULT_TMPL.format(idx=idx+1, name=res['filename'], status=res['status'], msg=res['message'], body=body)
+    error_html = ""
+    if res['error_details']:
+        error_html = _ERROR_TMPL.format(idx=idx+1, name=res['filename'], msg=res['message'], details=str(res['error_details']).translate(_HTML_TRANS))
+    return output_html, error_html
+
+
 # --- Gradio 主处理函数 ---
-async def analyze_audio_files(uploaded_files: list, selected_model_name: str, user_prompt: str, max_concurrent_workers: int):
+async def analyze_audio_files(uploaded_files: list, selected_model_name: str, user_prompt: str, max_concurrent_workers: int, requests_per_minute: int, compress_upload: bool = False, use_batch_api: bool = False):
     if not uploaded_files:
         gr.Warning("请上传至少一个音频文件！")
         yield ("", "任务中止：未提供文件。", "", "", gr.update(value=None, visible=False))
         return
 
-    selected_model_id = MODEL_MAPPING.get(selected_model_name, "gemini-1.5-flash-latest")
+    selected_model_id = MODEL_MAPPING.get(selected_model_name, DEFAULT_MODEL_ID)
+    # gr.Number 被清空时会传入 None，回退到默认值；本次任务的 RPM 只能在账号上限 DEFAULT_RPM 之内再调低
+    requests_per_minute = min(max(int(requests_per_minute or DEFAULT_RPM), 1), DEFAULT_RPM)
 
-    files_data_for_tasks, file_previews_html_list = [], []
-    for idx, file_obj in enumerate(uploaded_files):
+    files_data_for_tasks = []
+    for file_obj in uploaded_files:
         temp_file_path = str(file_obj)
         filename = os.path.basename(file_obj.name)
-        with open(temp_file_path, 'rb') as f:
-            audio_bytes = f.read()
-        mime_type, _ = mimetypes.guess_type(filename)
-        files_data_for_tasks.append({'filename': filename, 'bytes': audio_bytes, 'type': mime_type or 'application/octet-stream'})
-        file_previews_html_list.append(f"""<div style="margin-bottom: 10px;"><h4>文件 {idx+1}: {filename}</h4><audio controls src="file={temp_file_path}" style="width: 100%;"></audio><p>大小: {round(len(audio_bytes) / (1024 * 1024), 2)} MB</p></div>""")
-    
+        mime_type = _guess_mime(filename)
+        # 此处只记录路径，音频内容由工作任务在获得信号量后再读取
+        files_data_for_tasks.append({'filename': filename, 'path': temp_file_path, 'type': mime_type})
+
+    # 内容摘要在后台线程中计算，与预览文件的读取并行进行
+    hashes_future = asyncio.gather(*[asyncio.to_thread(_hash_file, data['path']) for data in files_data_for_tasks])
+    file_sizes = [os.path.getsize(data['path']) for data in files_data_for_tasks]
+    preview_srcs = await asyncio.gather(*[_preview_src(data['path'], data['type'], inline) for data, inline in zip(files_data_for_tasks, _inline_preview_flags(file_sizes))])
+    file_previews_html_list = [
+        _PREVIEW_TMPL.format(idx=idx+1, name=data['filename'], src=src, size=_fmt_size(size))
+        for idx, (data, src, size) in enumerate(zip(files_data_for_tasks, preview_srcs, file_sizes))
+    ]
+
     file_preview_markdown_content = f"""<div><h3>📤 已上传音频预览</h3>{"".join(file_previews_html_list)}</div>"""
     yield (file_preview_markdown_content, f"🚀 正在启动对 {len(uploaded_files)} 个文件的分析任务...", "", "", gr.update(visible=False))
 
-    semaphore = asyncio.Semaphore(max_concurrent_workers)
-    tasks = [async_gemini_analysis_task(user_prompt, data, selected_model_id, semaphore) for data in files_data_for_tasks]
-    results = await asyncio.gather(*tasks)
-    
-    output_md, error_md, df_data = "<h3>📊 分析结果概览</h3>", "", []
-    for idx, res in enumerate(results):
-        result_safe = html.escape(res['result']) if res['result'] else ""
-        output_md += f"""<div style="border: 1px solid #e0e0e0; padding: 15px; border-radius: 8px; margin-bottom: 15px;"><h4>文件 {idx+1}: {res['filename']} - 状态: <span style="font-weight:bold;">{res['status']}</span></h4><p><strong>消息:</strong> {res['message']}</p>"""
-        if res['result']:
-            output_md += f"<h5>分析结果:</h5><div style='background-color:#f9f9f9; padding: 10px; border-radius: 5px; white-space: pre-wrap; word-wrap: break-word;'>{result_safe}</div>"
-        if res['error_details']:
-            error_md += f"""<div><h4>文件 {idx+1}: {res['filename']} - 错误: {res['message']}</h4><pre><code>{html.escape(str(res['error_details']))}</code></pre></div>"""
-        output_md += "</div>"
-        df_data.append({
-            "文件名": res.get('filename'), "状态": res.get('status'), "消息": res.get('message'),
-            "分析结果": res.get('result'), "错误详情": res.get('error_details')
-        })
-
-    df = pd.DataFrame(df_data)
-    excel_name = f"gemini_audio_results_{pd.Timestamp.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-    
+    # 按内容摘要去重：相同音频只提交一次，结果再分发给所有重复文件
+    hashes = await hashes_future
+    for data, h in zip(files_data_for_tasks, hashes):
+        data['hash'] = h
+    duplicates_by_first = {}
+    for idx, h in enumerate(hashes):
+        duplicates_by_first.setdefault(h, []).append(idx)
+    duplicates_by_first = {indices[0]: indices for indices in duplicates_by_first.values()}
+
+    total, done = len(files_data_for_tasks), 0
+    results, output_slots, error_slots = [None] * total, [""] * total, [""] * total
+
     # --- 最终修复点 2: 创建一个临时文件来存储 Excel 数据 ---
     with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as tmp:
-        with pd.ExcelWriter(tmp.name, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='AnalysisResults')
-        # 获取临时文件的完整路径
         temp_file_path = tmp.name
+    excel_rows = queue.Queue()
+    excel_thread = threading.Thread(target=_excel_writer_worker, args=(excel_rows, temp_file_path), daemon=True)
+
+    def _apply_result(first_idx: int, res: dict) -> int:
+        for idx in duplicates_by_first[first_idx]:
+            results[idx] = {**res, 'filename': files_data_for_tasks[idx]['filename']}
+            output_slots[idx], error_slots[idx] = _render_result(idx, results[idx])
+            excel_rows.put((idx, results[idx]))
+        return len(duplicates_by_first[first_idx])
+
+    def _apply_partial(first_idx: int, text: str) -> None:
+        for idx in duplicates_by_first[first_idx]:
+            partial = {'filename': files_data_for_tasks[idx]['filename'], 'status': '⏳ 生成中', 'message': "正在接收结果...", 'result': text, 'error_details': None}
+            output_slots[idx], _ = _render_result(idx, partial)
+
+    # 指令文本在整批任务中相同，只构建一次 Part 供所有请求复用
+    prompt_part = genai.protos.Part(text=user_prompt)
+    semaphore = asyncio.Semaphore(int(max_concurrent_workers))
+    limiter = AsyncLimiter(max_rate=requests_per_minute, time_period=60)
+    aborted = False
+    tasks = []
+
+    def _finish(first_idx: int, res: dict) -> int:
+        if res['result'] is not None:
+            _cache_put(cache_keys[first_idx], res['result'])
+        return _apply_result(first_idx, res)
+
+    cache_keys = {first_idx: (hashes[first_idx], user_prompt, selected_model_id, bool(compress_upload)) for first_idx in duplicates_by_first}
+
+    try:
+        # 写入线程在 try 内启动，之后任何异常或中断都会经由 finally 发送结束标记并关闭工作簿
+        excel_thread.start()
+        uncached = []
+        for first_idx, key in cache_keys.items():
+            cached_text = _cache_get(key)
+            if cached_text is None:
+                uncached.append(first_idx)
+            else:
+                done += _apply_result(first_idx, {'filename': None, 'status': '✅ 完成', 'message': "分析成功（命中缓存）", 'result': cached_text, 'error_details': None})
+        if 0 < done < total:
+            yield (gr.update(), f"⏳ 已完成 {done}/{total} 个文件的分析...", "<h3>📊 分析结果概览</h3>" + "".join(output_slots), "", gr.update(visible=False))
+        if use_batch_api and uncached:
+            yield (gr.update(), f"📦 已通过 Batch API 提交 {len(uncached)} 个请求，服务端排队处理可能需要较长时间...", "<h3>📊 分析结果概览</h3>" + "".join(output_slots), "", gr.update(visible=False))
+            # 批处理在独立任务中运行，每次轮询的状态经队列回传，生成器借此持续刷新界面
+            batch_states = asyncio.Queue()
+            batch_task = asyncio.create_task(_run_batch_job(user_prompt, [files_data_for_tasks[idx] for idx in uncached], selected_model_id, semaphore, compress_upload, batch_states.put_nowait))
+            batch_task.add_done_callback(lambda _: batch_states.put_nowait(None))
+            tasks.append(batch_task)
+            batch_started = monotonic()
+            while (state := await batch_states.get()) is not None:
+                elapsed = int(monotonic() - batch_started)
+                yield (gr.update(), f"📦 Batch API 任务状态: {state}，已等待 {elapsed // 3600:d}:{elapsed // 60 % 60:02d}:{elapsed % 60:02d}...", gr.update(), "", gr.update(visible=False))
+            try:
+                batch_results = batch_task.result()
+            except Exception as e:
+                batch_results = [{'filename': None, 'status': '❌ 失败', 'message': f"批处理任务失败: {type(e).__name__}", 'result': None, 'error_details': str(e)}] * len(uncached)
+            for first_idx, res in zip(uncached, batch_results):
+                done += _finish(first_idx, res)
+            uncached = []
+
+        # 不使用 TaskGroup：生成器会在各次 yield 之间被挂起，子任务失败时由此处显式取消其余任务
+        events = asyncio.Queue()
+        for idx in uncached:
+            on_partial = lambda text, i=idx: events.put_nowait((i, text, None))
+            tasks.append(asyncio.create_task(_run_and_report(idx, async_gemini_analysis_task(prompt_part, files_data_for_tasks[idx], selected_model_id, semaphore, limiter, compress_upload, on_partial), events)))
+        loop, last_refresh, remaining = asyncio.get_running_loop(), 0.0, len(uncached)
+        # 每个任务只保留最新的部分文本，到刷新时刻才统一渲染，避免为每个分块生成 HTML
+        latest_partials = {}
+        while remaining:
+            # 有待渲染的部分文本时最多等到下一个刷新时刻，即使后续分块迟迟不到也能按时显示
+            try:
+                async with asyncio.timeout_at(last_refresh + _PARTIAL_REFRESH_INTERVAL if latest_partials else None):
+                    first_idx, partial_text, res = await events.get()
+            except TimeoutError:
+                first_idx, partial_text, res = None, None, None
+            if res is None:
+                if first_idx is not None:
+                    latest_partials[first_idx] = partial_text
+                if loop.time() - last_refresh >= _PARTIAL_REFRESH_INTERVAL:
+                    last_refresh = loop.time()
+                    for pending_idx, text in latest_partials.items():
+                        _apply_partial(pending_idx, text)
+                    latest_partials.clear()
+                    yield (gr.update(), f"⏳ 已完成 {done}/{total} 个文件的分析，正在接收结果...", "<h3>📊 分析结果概览</h3>" + "".join(output_slots), "", gr.update(visible=False))
+                continue
+            remaining -= 1
+            latest_partials.pop(first_idx, None)
+            if isinstance(res, FatalGeminiError):
+                # API Key 失效或配额耗尽：取消其余仍在排队或进行中的任务，并收集取消前已上报的结果
+                aborted = True
+                _apply_result(first_idx, res.result)
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                while not events.empty():
+                    other_idx, _, other = events.get_nowait()
+                    if isinstance(other, FatalGeminiError):
+                        _apply_result(other_idx, other.result)
+                    elif other is not None:
+                        done += _finish(other_idx, other)
+                for pending_idx in duplicates_by_first:
+                    if results[pending_idx] is None:
+                        _apply_result(pending_idx, {'filename': None, 'status': '⏹️ 已取消', 'message': "因致命错误已取消", 'result': None, 'error_details': None})
+                break
+            done += _finish(first_idx, res)
+            # 这次刷新也一并渲染其余任务尚未显示的部分文本，避免它们停留在上一次的内容
+            for pending_idx, text in latest_partials.items():
+                _apply_partial(pending_idx, text)
+            latest_partials.clear()
+            last_refresh = loop.time()
+            # 每完成一个任务即刷新界面，已完成的结果无需等待其余任务
+            output_md = "<h3>📊 分析结果概览</h3>" + "".join(output_slots)
+            if done < total:
+                yield (gr.update(), f"⏳ 已完成 {done}/{total} 个文件的分析...", output_md, "", gr.update(visible=False))
+    finally:
+        # 生成器被提前关闭（如用户取消）时，不留下仍在运行的分析任务
+        for task in tasks:
+            task.cancel()
+        excel_rows.put(None)
+    output_md = "<h3>📊 分析结果概览</h3>" + "".join(output_slots)
+    error_md = "".join(error_slots)
+
+    excel_name = f"gemini_audio_results_{strftime('%Y%m%d_%H%M%S', localtime())}.xlsx"
+    # 此时工作簿绝大部分已写完，等待写入线程收尾而不阻塞事件循环
+    await asyncio.to_thread(excel_thread.join)
 
     final_error_md = f"<h3>🐛 错误日志</h3>{error_md}" if error_md else ""
     
@@ -99,7 +667,8 @@ async def analyze_audio_files(uploaded_files: list, selected_model_name: str, us
         interactive=True
     )
     
-    yield (gr.update(), "✅ 所有任务处理完毕。", output_md, final_error_md, excel_update)
+    final_info = "⛔ 遇到致命错误，剩余任务已取消。" if aborted else "✅ 所有任务处理完毕。"
+    yield (gr.update(), final_info, output_md, final_error_md, excel_update)
 
 
 # --- Gradio 界面定义 ---
@@ -108,10 +677,13 @@ with gr.Blocks(title="Gemini Audio Assistant", theme=gr.themes.Soft(primary_hue=
     with gr.Row():
         with gr.Column(scale=1):
             gr.Markdown("## ⚙️ 系统控制台")
-            model_dropdown = gr.Dropdown(label="选择 AI 模型版本:", choices=list(MODEL_MAPPING.keys()), value=list(MODEL_MAPPING.keys())[0], type="value")
+            model_dropdown = gr.Dropdown(label="选择 AI 模型版本:", choices=MODEL_CHOICES, value=MODEL_CHOICES[0], type="value")
             file_uploader = gr.Files(label="拖放或点击上传音频文件", file_count="multiple", type="filepath", file_types=["audio"])
             prompt_textbox = gr.Textbox(label="输入您的分析指令或问题:", value="请详细描述这个音频剪辑的内容，识别其中的任何声音、音乐或语音。总结其主要信息。如果包含语音，请尝试转录关键信息。", lines=10, max_lines=20)
-            max_workers_slider = gr.Slider(label="并发处理限制 (1-10个任务):", minimum=1, maximum=10, value=5, step=1)
+            max_workers_slider = gr.Slider(label="并发处理限制 (1-10个任务):", minimum=1, maximum=10, value=DEFAULT_MAX_CONCURRENCY, step=1)
+            rpm_number = gr.Number(label=f"本次任务每分钟请求上限 (RPM，不超过账号上限 {DEFAULT_RPM}):", value=DEFAULT_RPM, minimum=1, maximum=DEFAULT_RPM, precision=0)
+            compress_checkbox = gr.Checkbox(label="压缩上传 (需要 ffmpeg，转码为 Opus 24kbps 16kHz 单声道)", value=False)
+            batch_api_checkbox = gr.Checkbox(label="使用 Batch API (费用约减半，服务端排队执行，可能需要较长时间)", value=False)
             analyze_button = gr.Button("🚀 启动数据分析", variant="primary")
         with gr.Column(scale=2):
             file_preview_output = gr.Markdown("""<div style="text-align: center; padding: 50px; border: 2px dashed #ccc; border-radius: 10px;"><h2>🌐 欢迎来到 Gemini 音频分析平台</h2><p>请在左侧上传音频文件，输入您的指令，然后点击 '启动数据分析'。</p></div>""")
@@ -121,7 +693,8 @@ with gr.Blocks(title="Gemini Audio Assistant", theme=gr.themes.Soft(primary_hue=
             excel_output = gr.File(label="下载分析结果", visible=False, interactive=False)
 
     outputs_list = [file_preview_output, info_message_output, analysis_results_output, error_details_output, excel_output]
-    analyze_button.click(fn=analyze_audio_files, inputs=[file_uploader, model_dropdown, prompt_textbox, max_workers_slider], outputs=outputs_list)
+    analyze_button.click(fn=analyze_audio_files, inputs=[file_uploader, model_dropdown, prompt_textbox, max_workers_slider, rpm_number, compress_checkbox, batch_api_checkbox], outputs=outputs_list, concurrency_limit=DEFAULT_EVENT_CONCURRENCY)
+    demo.load(fn=_warm_up_channel, inputs=None, outputs=None, show_progress="hidden")
 
 if __name__ == "__main__":
     demo.queue().launch(server_name="0.0.0.0", server_port=int(os.getenv("PORT", 7860)), show_api=False, debug=True)
\ No newline at end of file
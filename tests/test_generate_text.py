@@ -0,0 +1,65 @@
+import os
+import unittest
+
+os.environ.setdefault("GOOGLE_API_KEY", "test-key")
+
+import app  # noqa: E402
+from aiolimiter import AsyncLimiter  # noqa: E402
+
+
+class _Chunk:
+    def __init__(self, text):
+        self._text = text
+
+    @property
+    def text(self):
+        if not self._text:
+            raise ValueError("chunk has no text")
+        return self._text
+
+
+class _StreamResponse:
+    # 与 google-generativeai 一致：流未读完前访问 .text 会抛出异常
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._done = False
+
+    @property
+    def text(self):
+        if not self._done:
+            raise RuntimeError("IncompleteIterationError")
+        return ""
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return _Chunk(next(self._chunks))
+        except StopIteration:
+            self._done = True
+            raise StopAsyncIteration
+
+
+class _FakeModel:
+    def __init__(self, chunks):
+        self._chunks = chunks
+
+    async def generate_content_async(self, contents, stream=False):
+        return _StreamResponse(self._chunks)
+
+
+class GenerateTextTest(unittest.IsolatedAsyncioTestCase):
+    async def test_multi_chunk_stream_accumulates_text(self):
+        partials = []
+        text = await app._generate_text(_FakeModel(["part1 ", "part2", ""]), [], AsyncLimiter(100, 60), partials.append)
+        self.assertEqual(text, "part1 part2")
+        self.assertEqual(partials, ["part1 ", "part1 part2"])
+
+    async def test_stream_without_on_partial(self):
+        text = await app._generate_text(_FakeModel(["a", "b"]), [], AsyncLimiter(100, 60))
+        self.assertEqual(text, "ab")
+
+
+if __name__ == "__main__":
+    unittest.main()